@@ -1,8 +1,12 @@
 from dotenv import load_dotenv
 load_dotenv()
 import os
+import json
+import time
+import threading
+from collections import OrderedDict
 import httpx
-from database import SessionLocal, InvoiceDB
+from database import SessionLocal, InvoiceDB, get_invoice_version
 from sqlalchemy import func
 GROQ_API_KEY = os.getenv("GROQ_API_KEY", "YOUR_GROQ_API_KEY")
 print("GROQ_API_KEY:", GROQ_API_KEY)
@@ -31,7 +35,77 @@ SYSTEM_PROMPT = (
     "| 2  | INV-002   | Gamma Inc | 2024-03-20 | $450.75   | Unpaid  | Software      |\n"
 )
 
+CHAT_CACHE_TTL_SECONDS = float(os.getenv("CHAT_CACHE_TTL_SECONDS", "600"))
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "512"))
+
+class AnswerCache:
+    """LRU cache of chatbot answers with a TTL and hit/miss counters"""
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+answer_cache = AnswerCache(CHAT_CACHE_MAX_ENTRIES, CHAT_CACHE_TTL_SECONDS)
+
+def normalize_messages(messages) -> str:
+    """Canonical form of the chat history, ignoring whitespace differences"""
+    return json.dumps([
+        [str(m.get("role", "")).lower(), " ".join(str(m.get("content", "")).split())]
+        for m in messages
+    ])
+
 async def answer_query(messages, current_user) -> str:
+    # Read the version before the invoices: if an upload lands in between, the
+    # answer is cached under the older version and simply never hit again
+    cache_key = (current_user.id, get_invoice_version(current_user.id), normalize_messages(messages))
+    cached = answer_cache.get(cache_key)
+    if cached is not None:
+        print(f"DEBUG: Chatbot cache hit for user {current_user.username}")
+        return cached
+
     session = SessionLocal()
     invoices = session.query(InvoiceDB).filter(InvoiceDB.user_id == current_user.id).all()
     invoice_data = [
@@ -68,7 +142,9 @@ async def answer_query(messages, current_user) -> str:
             response = await client.post(GROQ_API_URL, headers=headers, json=payload, timeout=30)
             response.raise_for_status()
             data = response.json()
-            return data["choices"][0]["message"]["content"].strip()
+            answer = data["choices"][0]["message"]["content"].strip()
+            answer_cache.put(cache_key, answer)
+            return answer
         except httpx.HTTPStatusError as e:
             error_detail = ""
             try:
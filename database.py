@@ -1,7 +1,9 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Date, ForeignKey, text
+from sqlalchemy import create_engine, Column, Integer, String, Float, Date, ForeignKey, Index, event, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, Session
 import datetime
+import re
+import threading
 from passlib.context import CryptContext
 
 DATABASE_URL = "sqlite:///./invoices.db"
@@ -31,8 +33,84 @@ class InvoiceDB(Base):
     status = Column(String, nullable=False)
     category = Column(String, nullable=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    fingerprint = Column(String, nullable=True)
+    fuzzy_key = Column(String, nullable=True)
+    duplicate_of = Column(Integer, ForeignKey("invoices.id"), nullable=True)
     user = relationship("User", back_populates="invoices")
 
+    # Duplicate checks look up (user, key) on every insert
+    __table_args__ = (
+        Index("ix_invoices_user_fingerprint", "user_id", "fingerprint"),
+        Index("ix_invoices_user_fuzzy_key", "user_id", "fuzzy_key"),
+    )
+
+# Per-user invoice data version, bumped whenever a commit touches that user's
+# invoices. Cached chatbot answers are keyed on it so they go stale on change.
+_invoice_versions = {}
+_invoice_versions_lock = threading.Lock()
+
+def get_invoice_version(user_id: int) -> int:
+    with _invoice_versions_lock:
+        return _invoice_versions.get(user_id, 0)
+
+def bump_invoice_version(user_id: int):
+    with _invoice_versions_lock:
+        _invoice_versions[user_id] = _invoice_versions.get(user_id, 0) + 1
+
+@event.listens_for(Session, "after_flush")
+def _track_invoice_changes(session, flush_context):
+    changed = session.info.setdefault("changed_invoice_users", set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, InvoiceDB) and obj.user_id is not None:
+            changed.add(obj.user_id)
+
+@event.listens_for(Session, "after_commit")
+def _bump_invoice_versions(session):
+    # Bump only once the data is committed, so a reader can't cache an answer
+    # built from the old rows under the new version
+    for user_id in session.info.pop("changed_invoice_users", set()):
+        bump_invoice_version(user_id)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_invoice_changes(session):
+    session.info.pop("changed_invoice_users", None)
+
+# Placeholder upload stores when OCR finds no vendor name
+UNKNOWN_VENDOR = "Unknown Vendor"
+
+# Legal-form suffixes that OCR picks up inconsistently ("Acme Corp." vs "ACME")
+VENDOR_SUFFIXES = {"inc", "incorporated", "llc", "ltd", "limited", "corp", "corporation", "co", "company", "gmbh", "plc", "pvt"}
+
+def normalize_vendor(vendor: str) -> str:
+    """Lowercase, strip punctuation and drop trailing legal-form suffixes"""
+    words = re.sub(r"[^a-z0-9]+", " ", (vendor or "").lower()).split()
+    while len(words) > 1 and words[-1] in VENDOR_SUFFIXES:
+        words.pop()
+    return " ".join(words)
+
+def normalize_invoice_number(invoice_number: str) -> str:
+    """Keep only alphanumerics, uppercased, without leading zeros"""
+    cleaned = re.sub(r"[^A-Z0-9]", "", (invoice_number or "").upper())
+    return cleaned.lstrip("0") or cleaned
+
+def compute_keys(invoice_number, vendor, amount, date, date_known: bool = True):
+    """Return (fingerprint, fuzzy_key) for an invoice.
+
+    The fingerprint covers (vendor, invoice number, amount, date) and is None
+    when there is no usable invoice number. The fuzzy key leaves the invoice
+    number out so re-scans where OCR missed the number still match. It is None
+    when the vendor, amount or date is only a placeholder, otherwise every
+    unreadable upload on the same day would share one key.
+    """
+    vendor_key = "" if vendor == UNKNOWN_VENDOR else normalize_vendor(vendor)
+    amount_key = f"{round(amount, 2):.2f}" if amount else ""
+    date_key = date.isoformat() if date and date_known else ""
+    key = "|".join([vendor_key, amount_key, date_key])
+    fuzzy_key = key if vendor_key and amount_key and date_key else None
+    number = normalize_invoice_number(invoice_number)
+    fingerprint = f"{number}|{key}" if number else None
+    return fingerprint, fuzzy_key
+
 def hash_password(password):
     return pwd_context.hash(password)
 
@@ -71,6 +149,52 @@ def check_and_fix_database():
         init_mock_data()
         print("DEBUG: Database recreated due to error")
 
+def ensure_duplicate_columns():
+    """Add the duplicate-detection columns and indexes to an existing invoices table.
+
+    Done in place so upgrading doesn't go through check_and_fix_database's
+    drop-and-recreate path and lose stored invoices.
+    """
+    session = SessionLocal()
+    try:
+        result = session.execute(text("PRAGMA table_info(invoices)"))
+        columns = [col[1] for col in result.fetchall()]
+        for name, ddl in [
+            ("fingerprint", "VARCHAR"),
+            ("fuzzy_key", "VARCHAR"),
+            ("duplicate_of", "INTEGER REFERENCES invoices (id)"),
+        ]:
+            if name not in columns:
+                print(f"DEBUG: Adding column {name} to invoices")
+                session.execute(text(f"ALTER TABLE invoices ADD COLUMN {name} {ddl}"))
+        session.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_user_fingerprint ON invoices (user_id, fingerprint)"))
+        session.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_user_fuzzy_key ON invoices (user_id, fuzzy_key)"))
+        session.commit()
+    except Exception as e:
+        print(f"DEBUG: Error adding duplicate-detection columns: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+def backfill_duplicate_keys():
+    """Compute duplicate-detection keys for invoices stored before they existed"""
+    session = SessionLocal()
+    try:
+        missing = session.query(InvoiceDB).filter(
+            InvoiceDB.fingerprint.is_(None),
+            InvoiceDB.fuzzy_key.is_(None)
+        ).all()
+        for inv in missing:
+            inv.fingerprint, inv.fuzzy_key = compute_keys(inv.invoice_number, inv.vendor, inv.amount, inv.date)
+        if missing:
+            session.commit()
+            print(f"DEBUG: Backfilled duplicate keys for {len(missing)} invoices")
+    except Exception as e:
+        print(f"DEBUG: Error backfilling duplicate keys: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
 def init_mock_data():
     session = SessionLocal()
     print("DEBUG: Starting to seed mock data...")
@@ -111,6 +235,8 @@ def test_database():
 
 # Create tables
 Base.metadata.create_all(bind=engine)
+ensure_duplicate_columns()
+backfill_duplicate_keys()
 
 # Initialize mock data
 print("DEBUG: About to initialize mock data...")
@@ -0,0 +1,150 @@
+import os
+from sqlalchemy import func
+from database import InvoiceDB, UNKNOWN_VENDOR, compute_keys
+
+# What to do when an incoming invoice matches one the user already has:
+#   reject - refuse to store it
+#   merge  - keep the existing row, filling in any fields it is missing
+#   flag   - store it anyway, pointing duplicate_of at the existing row
+#
+# The policy applies as-is to exact fingerprint matches. A match on the fuzzy
+# key alone (one side has no invoice number) is only a possible duplicate, so
+# under reject it is flagged instead; merge still fills the number in on the
+# existing row, after which it stops matching other numbers.
+DUPLICATE_POLICIES = ("reject", "merge", "flag")
+DEFAULT_DUPLICATE_POLICY = os.getenv("DUPLICATE_POLICY", "reject")
+if DEFAULT_DUPLICATE_POLICY not in DUPLICATE_POLICIES:
+    raise RuntimeError(f"DUPLICATE_POLICY is set to '{DEFAULT_DUPLICATE_POLICY}'. Use one of: {', '.join(DUPLICATE_POLICIES)}")
+
+class DuplicateInvoiceError(Exception):
+    """Raised under the reject policy when an invoice is already stored"""
+    def __init__(self, existing: InvoiceDB):
+        self.existing = existing
+        super().__init__(f"Duplicate of invoice {existing.id}")
+
+def apply_keys(invoice: InvoiceDB, date_known: bool = True):
+    invoice.fingerprint, invoice.fuzzy_key = compute_keys(invoice.invoice_number, invoice.vendor, invoice.amount, invoice.date, date_known)
+
+def stored_date_known(invoice: InvoiceDB) -> bool:
+    """Whether a stored invoice's keys were computed from a date read off the invoice"""
+    if invoice.fingerprint:
+        return not invoice.fingerprint.endswith("|")
+    return invoice.fuzzy_key is not None
+
+def find_duplicate(session, invoice: InvoiceDB):
+    """Look up an existing invoice of the same user matching this one.
+
+    Returns (existing, exact) where exact tells a fingerprint match from a
+    fuzzy-key-only one, or (None, False). Both lookups go through the
+    (user_id, key) indexes, so the cost does not grow with the number of
+    invoices the user has.
+    """
+    if invoice.fingerprint:
+        existing = session.query(InvoiceDB).filter(
+            InvoiceDB.user_id == invoice.user_id,
+            InvoiceDB.fingerprint == invoice.fingerprint
+        ).first()
+        if existing:
+            return existing, True
+    if not invoice.fuzzy_key:
+        return None, False
+    query = session.query(InvoiceDB).filter(
+        InvoiceDB.user_id == invoice.user_id,
+        InvoiceDB.fuzzy_key == invoice.fuzzy_key
+    )
+    if invoice.fingerprint:
+        # Two different invoice numbers are two different invoices; only match
+        # rows that never had a number to compare against
+        query = query.filter(InvoiceDB.fingerprint.is_(None))
+    return query.first(), False
+
+def save_invoice(session, invoice: InvoiceDB, policy: str = DEFAULT_DUPLICATE_POLICY, date_known: bool = True):
+    """Insert an invoice, applying the duplicate policy. Shared by every write path.
+
+    Pass date_known=False when invoice.date is a fallback rather than a date
+    read off the invoice.
+
+    Returns (stored_invoice, duplicate_of) where duplicate_of is the id of the
+    existing invoice that matched, or None. Raises DuplicateInvoiceError under
+    reject for exact matches; fuzzy-only matches are flagged instead.
+    """
+    if policy not in DUPLICATE_POLICIES:
+        raise ValueError(f"Unknown duplicate policy '{policy}'. Use one of: {', '.join(DUPLICATE_POLICIES)}")
+
+    apply_keys(invoice, date_known)
+    existing, exact = find_duplicate(session, invoice)
+
+    if existing is None:
+        session.add(invoice)
+        session.commit()
+        session.refresh(invoice)
+        return invoice, None
+
+    print(f"DEBUG: Invoice {'matches' if exact else 'possibly matches'} existing invoice {existing.id} (policy: {policy})")
+
+    if policy == "reject" and exact:
+        raise DuplicateInvoiceError(existing)
+
+    if policy == "merge":
+        if not existing.invoice_number and invoice.invoice_number:
+            existing.invoice_number = invoice.invoice_number
+            # Only the fingerprint can change here; the fuzzy key ignores the number
+            existing.fingerprint, _ = compute_keys(existing.invoice_number, existing.vendor, existing.amount, existing.date, stored_date_known(existing))
+        if not existing.category and invoice.category:
+            existing.category = invoice.category
+        session.commit()
+        session.refresh(existing)
+        return existing, existing.id
+
+    invoice.duplicate_of = existing.duplicate_of or existing.id
+    session.add(invoice)
+    session.commit()
+    session.refresh(invoice)
+    return invoice, invoice.duplicate_of
+
+def duplicate_report(session, user_id: int):
+    """Group a user's stored invoices that share a fingerprint or fuzzy key"""
+    groups = []
+
+    exact = session.query(InvoiceDB.fingerprint).filter(
+        InvoiceDB.user_id == user_id,
+        InvoiceDB.fingerprint.isnot(None)
+    ).group_by(InvoiceDB.fingerprint).having(func.count(InvoiceDB.id) > 1).all()
+    for (fingerprint,) in exact:
+        rows = session.query(InvoiceDB).filter(
+            InvoiceDB.user_id == user_id,
+            InvoiceDB.fingerprint == fingerprint
+        ).order_by(InvoiceDB.id).all()
+        groups.append({"match": "exact", "key": fingerprint, "invoice_ids": [inv.id for inv in rows]})
+
+    # Same rule as find_duplicate: rows sharing a fuzzy key are possible
+    # duplicates as long as at least one of them has no invoice number
+    fuzzy = session.query(InvoiceDB.fuzzy_key).filter(
+        InvoiceDB.user_id == user_id,
+        InvoiceDB.fuzzy_key.isnot(None)
+    ).group_by(InvoiceDB.fuzzy_key).having(
+        func.count(InvoiceDB.id) > 1,
+        func.count(InvoiceDB.fingerprint) < func.count(InvoiceDB.id)
+    ).all()
+    for (fuzzy_key,) in fuzzy:
+        rows = session.query(InvoiceDB).filter(
+            InvoiceDB.user_id == user_id,
+            InvoiceDB.fuzzy_key == fuzzy_key
+        ).order_by(InvoiceDB.id).all()
+        groups.append({"match": "fuzzy", "key": fuzzy_key, "invoice_ids": [inv.id for inv in rows]})
+
+    # Flagged inserts no longer grouped above, e.g. because a later merge gave
+    # the original row its own invoice number
+    reported = {invoice_id for group in groups for invoice_id in group["invoice_ids"]}
+    flagged = session.query(InvoiceDB).filter(
+        InvoiceDB.user_id == user_id,
+        InvoiceDB.duplicate_of.isnot(None)
+    ).order_by(InvoiceDB.id).all()
+    flagged_groups = {}
+    for inv in flagged:
+        if inv.id not in reported:
+            flagged_groups.setdefault(inv.duplicate_of, []).append(inv.id)
+    for original_id, duplicate_ids in flagged_groups.items():
+        groups.append({"match": "flagged", "key": None, "invoice_ids": [original_id] + duplicate_ids})
+
+    return groups
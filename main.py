@@ -7,10 +7,11 @@ from database import SessionLocal, User, InvoiceDB
 from models import Invoice as InvoiceModel
 import os
 from datetime import datetime, timedelta
-from chatbot import answer_query
+from chatbot import answer_query, answer_cache
 from typing import List, Dict
 from pydantic import BaseModel
 from ocr import extract_structured_data, Invoice as OCRInvoice
+from dedup import save_invoice, duplicate_report, DuplicateInvoiceError, DUPLICATE_POLICIES, DEFAULT_DUPLICATE_POLICY, UNKNOWN_VENDOR
 import tempfile
 import shutil
 import re
@@ -53,8 +54,13 @@ def determine_category(vendor_name: str, customer_name: str = None) -> str:
 
 def parse_date(date_str):
     """Parse various date formats from OCR output"""
+    # If no format matches, return today's date
+    return try_parse_date(date_str) or datetime.now().date()
+
+def try_parse_date(date_str):
+    """Parse various date formats from OCR output, returning None if none match"""
     if not date_str:
-        return datetime.now().date()
+        return None
     
     # Try different date formats
     date_formats = [
@@ -74,8 +80,7 @@ def parse_date(date_str):
         except ValueError:
             continue
     
-    # If no format matches, return today's date
-    return datetime.now().date()
+    return None
 
 def verify_password(plain_password, hashed_password):
     """Verify password safely, handling invalid/unknown hash formats.
@@ -249,11 +254,29 @@ def list_invoices(current_user: User = Depends(get_current_user)):
     session.close()
     return result
 
+@app.get("/invoices/duplicates")
+def list_duplicate_invoices(current_user: User = Depends(get_current_user)):
+    """Report groups of the user's stored invoices that look like duplicates"""
+    session = SessionLocal()
+    try:
+        groups = duplicate_report(session, current_user.id)
+        print(f"DEBUG: Found {len(groups)} duplicate groups for user {current_user.username}")
+        return {"duplicates": groups, "count": len(groups)}
+    finally:
+        session.close()
+
 @app.post("/upload-invoice/")
 async def upload_invoice(
     file: UploadFile = File(...),
+    on_duplicate: str = Query(default=DEFAULT_DUPLICATE_POLICY),
     current_user: User = Depends(get_current_user)
 ):
+    if on_duplicate not in DUPLICATE_POLICIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported on_duplicate policy. Allowed: {', '.join(DUPLICATE_POLICIES)}"
+        )
+
     # Validate file type
     allowed_extensions = {'.pdf', '.jpg', '.jpeg', '.png', '.webp'}
     file_ext = os.path.splitext(file.filename)[1].lower()
@@ -279,13 +302,14 @@ async def upload_invoice(
         # Convert OCR result to database format and save
         session = SessionLocal()
         
-        # Parse the date using the flexible parser
-        parsed_date = parse_date(ocr_result.date)
+        # Parse the date using the flexible parser, remembering whether it was readable
+        read_date = try_parse_date(ocr_result.date)
+        parsed_date = read_date or datetime.now().date()
         
         # Create new invoice in database
         new_invoice = InvoiceDB(
             invoice_number=ocr_result.invoice_number,
-            vendor=ocr_result.vendor_name or "Unknown Vendor",
+            vendor=ocr_result.vendor_name or UNKNOWN_VENDOR,
             date=parsed_date,
             amount=ocr_result.total_gross_worth or 0.0,
             status="Unpaid",  # Default status for new invoices
@@ -295,17 +319,30 @@ async def upload_invoice(
         
         print(f"DEBUG: Creating invoice - Vendor: {new_invoice.vendor}, Amount: {new_invoice.amount}, User ID: {new_invoice.user_id}")
         
-        session.add(new_invoice)
-        session.commit()
-        session.refresh(new_invoice)
+        try:
+            saved_invoice, duplicate = save_invoice(session, new_invoice, on_duplicate, date_known=read_date is not None)
+        except DuplicateInvoiceError as e:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Invoice already exists (duplicate of invoice {e.existing.id})",
+                headers={"X-Duplicate-Of": str(e.existing.id)}
+            )
+        finally:
+            session.close()
         
-        print(f"DEBUG: Invoice saved with ID: {new_invoice.id}")
+        print(f"DEBUG: Invoice saved with ID: {saved_invoice.id}")
         
-        session.close()
+        if duplicate is None:
+            message = "Invoice uploaded and processed successfully"
+        elif on_duplicate == "merge":
+            message = "Invoice already exists; merged into existing invoice"
+        else:
+            message = "Invoice uploaded and flagged as a possible duplicate"
         
         return {
-            "message": "Invoice uploaded and processed successfully",
-            "invoice_id": new_invoice.id,
+            "message": message,
+            "invoice_id": saved_invoice.id,
+            "duplicate_of": duplicate,
             "extracted_data": {
                 "invoice_number": ocr_result.invoice_number,
                 "vendor": ocr_result.vendor_name,
@@ -316,6 +353,8 @@ async def upload_invoice(
             }
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         # Clean up temp file if it exists
         if 'temp_path' in locals():
@@ -354,6 +393,11 @@ def debug_db_schema():
     finally:
         session.close() 
 
+@app.get("/debug/chatbot-cache")
+def debug_chatbot_cache():
+    """Debug endpoint to check chatbot answer cache metrics"""
+    return answer_cache.stats()
+
 @app.get("/debug/users")
 def debug_users():
     """Debug endpoint to check what users exist in the database"""